@@ -5,9 +5,10 @@ Author: Jason Stratman
 Storage covert channel steganography file timestamp implementation.
 """
 
-import math
 import random
 import os
+from operator import itemgetter
+from pathlib import Path
 import sys
 import traceback
 import time
@@ -16,12 +17,40 @@ import datetime
 # Used for argument management when running the program.
 import argparse
 
-# Used for correction of minor errors.
-import reedsolo
+# Used to issue the per-file timestamp syscalls concurrently.
+from concurrent.futures import ThreadPoolExecutor
+
+# Used to batch per-file timestamp values into arrays.
+import numpy as np
+
+# Used to compile the hot per-file digit loops to native code.
+from numba import njit
+
+# Used for correction of minor errors. The C-accelerated creedsolo
+# extension is a drop-in replacement for the pure-Python reedsolo
+# backend, so prefer it when it is installed.
+try:
+    from creedsolo import RSCodec
+except ImportError:
+    import reedsolo
+    from reedsolo import RSCodec
+
+    # Precompute the full 64 KiB GF(2^8) product table once and swap
+    # reedsolo's gf_mul (a log/antilog lookup with a zero-operand
+    # branch) for a single flat table lookup, since it sits inside the
+    # hot encode/decode loops of the pure-Python fallback. The
+    # log/antilog tables gf_mul reads are import-time placeholders
+    # until init_tables() fills them in.
+    reedsolo.init_tables()
+    _gf_mul_table = bytearray(256 * 256)
+    for _a in range(256):
+        for _b in range(256):
+            _gf_mul_table[(_a << 8) | _b] = reedsolo.gf_mul(_a, _b)
+    reedsolo.gf_mul = lambda x, y, _table=_gf_mul_table: _table[(x << 8) | y]
 
 # Used to check file types when determining suitable
 # files for data storage.
-from stat import S_ISREG, ST_MODE
+from stat import S_ISREG
 
 # Used to alter the creation date time value.
 # Can only alter up to a millisecond precision.
@@ -75,49 +104,36 @@ def arguments():
     return args
 
 
-def chunk_list(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
-
-def change_file_creation_time(fname, newtime):
+def change_file_creation_time(fname, newtime, atime=None, mtime=None):
     wintime = pywintypes.Time(newtime).replace(microsecond=newtime.microsecond)
+    if atime is not None:
+        atime = pywintypes.Time(atime).replace(microsecond=atime.microsecond)
+    if mtime is not None:
+        mtime = pywintypes.Time(mtime).replace(microsecond=mtime.microsecond)
+
     winfile = win32file.CreateFile(
         fname, win32con.GENERIC_WRITE,
         win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
         None, win32con.OPEN_EXISTING,
         win32con.FILE_ATTRIBUTE_NORMAL, None)
 
-    win32file.SetFileTime(winfile, wintime, None, None)
+    win32file.SetFileTime(winfile, wintime, atime, mtime)
 
     winfile.close()
 
 
 def floor_thousands(value):
-    return math.floor(value / 1000) * 1000
+    return value // 1000 * 1000
 
 
 def floor_hundred_thousands(value):
-    return math.floor(value / 100000) * 100000
+    return value // 100000 * 100000
 
 
 def floor_billionths(value):
-    return math.floor(value / 1000000000) * 1000000000
-
-
-def prepend_zeroes(num_string, n):
-    while len(num_string) < n:
-        num_string = '0' + num_string
-    return num_string
-
-
-def int_to_bytes(x):
-    return x.to_bytes((x.bit_length() + 7) // 8, 'big')
-
-
-def int_from_bytes(xbytes):
-    return int.from_bytes(xbytes, 'big')
+    # Integer floor division: float round-tripping loses precision on
+    # 64-bit nanosecond timestamps.
+    return value // 1000000000 * 1000000000
 
 
 def int_byte_size(digits):
@@ -125,67 +141,140 @@ def int_byte_size(digits):
 
 
 DIGITS_FOR_INDEX = 4
+# Largest value the index digits can hold.
+MAX_INDEX = 10**DIGITS_FOR_INDEX - 1
 STORABLE_DIGITS_PER_FILE = 17 - DIGITS_FOR_INDEX
 STORABLE_BYTES_PER_FILE = int_byte_size(STORABLE_DIGITS_PER_FILE - 1)
 # Bytes out of 255 that should be used for error correction
 ERROR_CORRECTING_BYTES = 50
 
 
+@njit(cache=True)
+def format_chunk_values(values, out):
+    """
+    Render each per-file chunk value as zero-padded decimal ASCII
+    digits in the preallocated buffer.
+    """
+    for i in range(values.shape[0]):
+        v = values[i]
+        for k in range(out.shape[1] - 1, -1, -1):
+            out[i, k] = v % 10 + 48
+            v //= 10
+
+
+@njit(cache=True)
+def encode_int_strings(ctime_ms, atime_ns, mtime_ns, out):
+    """
+    Write the 17 decimal digits encoded by each file's timestamps into
+    the preallocated ASCII buffer: 3 ctime millisecond digits, then 7
+    atime and 7 mtime digits covering the millisecond through hundred
+    nanosecond places.
+    """
+    for i in range(ctime_ms.shape[0]):
+        c = ctime_ms[i]
+        for k in range(2, -1, -1):
+            out[i, k] = c % 10 + 48
+            c //= 10
+        a = (atime_ns[i] % 1000000000) // 100
+        for k in range(9, 2, -1):
+            out[i, k] = a % 10 + 48
+            a //= 10
+        m = (mtime_ns[i] % 1000000000) // 100
+        for k in range(16, 9, -1):
+            out[i, k] = m % 10 + 48
+            m //= 10
+
+
+@njit(cache=True)
+def parse_int_buffer(buffer, indexes, payloads):
+    """
+    Parse each 17-digit ASCII record in the buffer into its index and
+    payload values.
+    """
+    for i in range(buffer.shape[0]):
+        index = 0
+        for k in range(DIGITS_FOR_INDEX):
+            index = index * 10 + (buffer[i, k] - 48)
+        indexes[i] = index
+        payload = 0
+        for k in range(DIGITS_FOR_INDEX, 17):
+            payload = payload * 10 + (buffer[i, k] - 48)
+        payloads[i] = payload
+
+
 class CovertChannel:
 
-    @staticmethod
-    def hide(storage_path: str, input_path: str):
+    # Shared codec instance so the generator polynomial and lookup
+    # tables are only built once per run instead of once per
+    # encode/decode call.
+    _RSC = RSCodec(ERROR_CORRECTING_BYTES)
+
+    @classmethod
+    def hide(cls, storage_path: str, input_path: str):
         """
         Used to hide data at the specified input path in the specified
         storage path directory of files.
         """
         # Read file data
-        file_data = CovertChannel.file_to_binary(input_path)
+        file_data = cls.file_to_binary(input_path)
         file_and_path = file_data + b'.' + \
             str.encode(input_path.split('.')[-1])
 
         # Apply error correcting code
-        encoded_data = reedsolo.RSCodec(
-            ERROR_CORRECTING_BYTES).encode(file_and_path)
-
-        while len(encoded_data) % STORABLE_BYTES_PER_FILE != 0:
-            encoded_data = bytearray(b'\x00') + encoded_data
+        encoded_data = cls._RSC.encode(file_and_path)
 
         index = 0
         int_str_chunks = []
 
         print('Able to store {} bytes per file'.format(STORABLE_BYTES_PER_FILE))
         print('Max able to store in {} files is {} bytes'.format(
-            '9'*DIGITS_FOR_INDEX, STORABLE_BYTES_PER_FILE*(int('9'*DIGITS_FOR_INDEX))))
-
-        data_chunks = list(chunk_list(encoded_data, STORABLE_BYTES_PER_FILE))
-
-        remaining_chunks = len(data_chunks)
-
-        if remaining_chunks > int('9'*DIGITS_FOR_INDEX) - 1:
+            MAX_INDEX, STORABLE_BYTES_PER_FILE*MAX_INDEX))
+
+        # Left-pad once so the payload splits evenly into per-file
+        # chunks, then view it as an (N, bytes-per-file) array.
+        padding = -len(encoded_data) % STORABLE_BYTES_PER_FILE
+        chunks = np.frombuffer(
+            bytes(encoded_data).rjust(len(encoded_data) + padding, b'\x00'),
+            np.uint8).reshape(-1, STORABLE_BYTES_PER_FILE)
+
+        # Fold each big-endian chunk into a single integer and render
+        # all of the zero-padded decimal payloads in one native pass.
+        shifts = np.arange(STORABLE_BYTES_PER_FILE - 1, -1, -1,
+                           dtype=np.uint64) * np.uint64(8)
+        chunk_values = (chunks.astype(np.uint64) << shifts).sum(
+            axis=1, dtype=np.uint64)
+
+        out = np.empty(
+            (len(chunk_values), STORABLE_DIGITS_PER_FILE), np.uint8)
+        format_chunk_values(chunk_values, out)
+        data_strings = [
+            row.decode('ascii') for row in out.view(
+                'S{}'.format(STORABLE_DIGITS_PER_FILE)).ravel().tolist()]
+
+        remaining_chunks = len(data_strings)
+
+        if remaining_chunks > MAX_INDEX - 1:
             raise Exception('Can only store up to {} files worth of data, need {}'.format(
-                int('9'*DIGITS_FOR_INDEX) - 1, remaining_chunks))
+                MAX_INDEX - 1, remaining_chunks))
 
-        for c in data_chunks:
-            s = str(int_from_bytes(c))
-
-            if len(s) > STORABLE_DIGITS_PER_FILE:
-                raise Exception('Data too long: {}'.format(len(s)))
-
-            if index == 0 or index == int('9'*DIGITS_FOR_INDEX) - 1:
+        for s in data_strings:
+            if index == 0 or index == MAX_INDEX - 1:
                 # Index chunk indicates the number of files
-                index_string = CovertChannel.prepend_chunk(
-                    str(0), str(remaining_chunks))
+                index_string = '{:0{}d}{:0{}d}'.format(
+                    0, DIGITS_FOR_INDEX,
+                    remaining_chunks, STORABLE_DIGITS_PER_FILE)
                 int_str_chunks.append(index_string)
                 index = 1
-                remaining_chunks -= (int('9'*DIGITS_FOR_INDEX) - 1)
+                remaining_chunks -= (MAX_INDEX - 1)
 
-            data_string = CovertChannel.prepend_chunk(str(index), s)
+            # The payload digits are already padded, so only the index
+            # prefix needs formatting.
+            data_string = '{:0{}d}'.format(index, DIGITS_FOR_INDEX) + s
             int_str_chunks.append(data_string)
             index += 1
 
         # Get the sorted list of files
-        files = CovertChannel.get_file_list(storage_path)
+        files = cls.get_file_list(storage_path)
 
         print('Data storage will require {} files'.format(
             len(int_str_chunks)))
@@ -194,34 +283,46 @@ class CovertChannel:
             raise Exception(
                 'Not enough files to store data. Need {}, found {}'.format(len(int_str_chunks), len(files)))
 
-         # Set all files microseconds time to 999999
-        for file in files:
+        # Compute every file's reset seconds in one vectorized pass,
+        # leaving only the syscall itself in the per-file worker.
+        # SetFileTime goes through datetimes and so writes with
+        # microsecond granularity; the reset marker only needs the
+        # index digits to read all 9s, so microsecond=999999 serves as
+        # the sentinel on all three timestamps.
+        atime_secs = np.fromiter(
+            (file[2] for file in files), np.uint64, len(files)) // 1000000000
+        mtime_secs = np.fromiter(
+            (file[3] for file in files), np.uint64, len(files)) // 1000000000
+
+        def _reset(file_and_secs):
+            # Set the file's microseconds times to 999999
+            file, atime_s, mtime_s = file_and_secs
             path = file[1]
-            ctimestamp = file[0]
+            ctime_ns = file[0]
+
+            # Skip files already carrying the reset values, e.g. from a
+            # previous run over the same directory, to save the
+            # expensive CreateFile round-trip per file.
+            if (ctime_ns % 1000000000 // 1000 == 999999
+                    and file[2] % 1000000000 == 999999000
+                    and file[3] % 1000000000 == 999999000):
+                return
+
+            # One CreateFile/SetFileTime call covers all three
+            # timestamps instead of SetFileTime plus a utime reopen.
             change_file_creation_time(
-                path, ctimestamp.replace(microsecond=999999))
-
-            atime_ns = file[2]
-            mtime_ns = file[3]
-            # ms through hundred ns places (7 values)
-            new_atime_ns = floor_billionths(
-                atime_ns) + (9999999 * 100)
-            # ms through hundred ns places (7 values)
-            new_mtime_ns = floor_billionths(
-                mtime_ns) + (9999999 * 100)
-            os.utime(path, ns=(new_atime_ns, new_mtime_ns))
-
-        # Choose random offset to start at
-        offset = random.randint(
-            0, len(files) - len(int_str_chunks))
-        del files[:offset]
-
-        files_count = 0
-
-        for c in int_str_chunks:
-            file = files.pop(0)
-
-            ctime = file[0]
+                path,
+                datetime.datetime.fromtimestamp(
+                    ctime_ns / 1000000000).replace(microsecond=999999),
+                atime=datetime.datetime.fromtimestamp(
+                    atime_s).replace(microsecond=999999),
+                mtime=datetime.datetime.fromtimestamp(
+                    mtime_s).replace(microsecond=999999))
+
+        def _embed(file_and_chunk):
+            file, c = file_and_chunk
+
+            ctime_ns = file[0]
             atime_ns = file[2]
             mtime_ns = file[3]
             path = file[1]
@@ -236,113 +337,117 @@ class CovertChannel:
                 mtime_ns) + (int(c[10:17]) * 100)
 
             change_file_creation_time(
-                path, ctime.replace(microsecond=new_ctime))
+                path, datetime.datetime.fromtimestamp(
+                    ctime_ns / 1000000000).replace(microsecond=new_ctime))
 
+            # The payload carries hundred-nanosecond digits, which a
+            # datetime-backed SetFileTime cannot represent, so atime
+            # and mtime stay on the nanosecond utime path here.
             os.utime(path, ns=(new_atime_ns, new_mtime_ns))
 
-            files_count += 1
-
-        print('Successfully embedded data in {} files'.format(files_count))
-
-    @staticmethod
-    def prepend_chunk(index_val: str, data_val: str):
-        # Pad index to be 4 digits long
-        index = prepend_zeroes(index_val, DIGITS_FOR_INDEX)
-        # Pad data to be 13 digits long
-        data = prepend_zeroes(data_val, STORABLE_DIGITS_PER_FILE)
-        return index + data
+        # The per-file timestamp updates are syscall-bound and release
+        # the GIL, so dispatch them across a thread pool.
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Set all files microseconds time to 999999
+            list(executor.map(
+                _reset,
+                zip(files, atime_secs.tolist(), mtime_secs.tolist())))
+
+            # Choose random offset to start at
+            offset = random.randint(
+                0, len(files) - len(int_str_chunks))
+
+            list(executor.map(
+                _embed,
+                zip(files[offset:offset + len(int_str_chunks)],
+                    int_str_chunks)))
+
+        print('Successfully embedded data in {} files'.format(
+            len(int_str_chunks)))
 
-    @staticmethod
-    def extract(storage_path: str, output_path: str):
+    @classmethod
+    def extract(cls, storage_path: str, output_path: str):
         """
         Used to extract data from the specified directory at the storage
         path, and will write the extracted data to a file at the specified
         output path.
         """
-        encoded_int_strings = CovertChannel.get_encoded_int_string(
-            storage_path)
-
-        found_start = False
-        next_index = 0
-        encoded_data = bytearray()
-        files_remaining = 0
-        files_captured = 0
-
-        for string in sorted(encoded_int_strings):
-            index = int(string[0:DIGITS_FOR_INDEX])
-
-            if index != 0:
-                if not found_start:
-                    continue
-                elif files_remaining > 0:
-
-                    files_remaining -= 1
-                    files_captured += 1
-
-                    byte = bytearray(int_to_bytes(
-                        int(string[DIGITS_FOR_INDEX:])))
-
-                    newbyte = bytes(byte)
-                    while len(newbyte) < STORABLE_BYTES_PER_FILE:
-                        newbyte = b'\x00' + bytes(newbyte)
-
-                    encoded_data += bytearray(newbyte)
-                    next_index += 1
-                else:
-                    break
-            else:
-                found_start = True
-                files_remaining = int(string[DIGITS_FOR_INDEX:])
-                next_index = 1
-                files_captured += 1
+        buffer = cls.get_encoded_int_buffer(storage_path)
+
+        # Parse every index and payload in one native pass instead of
+        # running int() on slices per file.
+        indexes = np.empty(len(buffer), np.uint64)
+        payloads = np.empty(len(buffer), np.uint64)
+        parse_int_buffer(buffer, indexes, payloads)
+
+        # Read the file count from the index records up front so only
+        # the files that actually carry payload need ordering, rather
+        # than sorting every record in the directory.
+        start_records = np.flatnonzero(indexes == 0)
+        if len(start_records) > 0:
+            # When several index records exist, the largest count
+            # wins. hide never stores more than MAX_INDEX - 1 chunks,
+            # so cap a corrupt count before it sizes the buffer below.
+            files_remaining = min(
+                int(payloads[start_records].max()), MAX_INDEX - 1)
+        else:
+            files_remaining = 0
+
+        selected = np.flatnonzero(
+            (indexes > 0) & (indexes <= files_remaining))
+
+        # Place each payload at the slot its index names; no sort is
+        # needed, and a missing file leaves a zero chunk at the right
+        # offset for the error correction to repair instead of
+        # shifting every later chunk.
+        encoded_data = bytearray(
+            STORABLE_BYTES_PER_FILE * files_remaining)
+        # A perturbed timestamp can push the digit field past what the
+        # chunk width holds; clamp so one bad file stays a chunk-sized
+        # error for the error correction instead of an OverflowError.
+        max_chunk_value = 2**(8 * STORABLE_BYTES_PER_FILE) - 1
+        for i in selected:
+            write_offset = (int(indexes[i]) - 1) * STORABLE_BYTES_PER_FILE
+            encoded_data[write_offset:write_offset + STORABLE_BYTES_PER_FILE] = \
+                min(int(payloads[i]), max_chunk_value).to_bytes(
+                    STORABLE_BYTES_PER_FILE, 'big')
+
+        files_captured = len(selected) + len(start_records)
 
         print('Found data for {} files'.format(files_captured))
 
         # Trim leading zero bytes
-        while bytes(encoded_data)[0] == 0:
-            encoded_data = encoded_data[1:]
+        encoded_data = bytes(encoded_data).lstrip(b'\x00')
 
         # Decode the message from ECC message
-        decoded_message = reedsolo.RSCodec(
-            ERROR_CORRECTING_BYTES).decode(encoded_data)
+        decoded_message = cls._RSC.decode(encoded_data)
 
         # Retrieve original file extension
         message_and_data = decoded_message.rsplit(b'.', 1)
         message = message_and_data[0]
         ext = message_and_data[1]
 
-        to_save = open(output_path + '.' + ext.decode("utf-8"), 'wb')
-        to_save.write(message)
+        # write_bytes opens, writes and closes in one call.
+        Path(output_path + '.' + ext.decode("utf-8")).write_bytes(
+            bytes(message))
 
     @staticmethod
-    def pad_byte(byte):
-        while len(byte) < STORABLE_BYTES_PER_FILE:
-            byte = bytearray(b'\x00') + byte
-
-        return byte
-
-    @staticmethod
-    def get_encoded_int_string(storage_path: str):
-        encoded_int_strings = []
-
-        for file in CovertChannel.get_file_list(storage_path):
-
-            ctimestamp = file[0]
-            atime_ns = file[2]
-            mtime_ns = file[3]
-
-            ctime_str_val = prepend_zeroes(
-                str(int(ctimestamp.microsecond / 1000)), 3)
-            atime_str_val = prepend_zeroes(
-                str(int((atime_ns % 1000000000) / 100)), 7)
-            mtime_str_val = prepend_zeroes(
-                str(int((mtime_ns % 1000000000) / 100)), 7)
+    def get_encoded_int_buffer(storage_path: str):
+        files = CovertChannel.get_file_list(storage_path)
 
-            int_string_val = ctime_str_val + atime_str_val + mtime_str_val
+        ctime_ms = np.fromiter(
+            (file[0] % 1000000000 // 1000000 for file in files),
+            np.uint64, len(files))
+        atime_ns = np.fromiter(
+            (file[2] for file in files), np.uint64, len(files))
+        mtime_ns = np.fromiter(
+            (file[3] for file in files), np.uint64, len(files))
 
-            encoded_int_strings.append(int_string_val)
+        out = np.empty((len(files), 17), np.uint8)
+        encode_int_strings(ctime_ms, atime_ns, mtime_ns, out)
 
-        return encoded_int_strings
+        return out
 
     @staticmethod
     def file_to_binary(file_path: str):
@@ -357,13 +462,19 @@ class CovertChannel:
 
     @staticmethod
     def get_file_list(file_path: str):
-        entries = (os.path.join(file_path, fn) for fn in os.listdir(file_path))
-        entries = ((os.stat(path), path) for path in entries)
-
-        entries = ((datetime.datetime.fromtimestamp(stat.st_ctime), path, stat.st_atime_ns, stat.st_mtime_ns)
-                   for stat, path in entries if S_ISREG(stat[ST_MODE]))
-
-        return sorted(entries)
+        # scandir hands back the stat result gathered during directory
+        # enumeration, avoiding a second stat syscall per entry.
+        entries = []
+        with os.scandir(file_path) as it:
+            for entry in it:
+                stat = entry.stat()
+                if S_ISREG(stat.st_mode):
+                    entries.append((stat.st_ctime_ns, entry.path,
+                                    stat.st_atime_ns, stat.st_mtime_ns))
+
+        # Sort on the integer ctime alone; comparing the full tuples
+        # would fall through to path comparisons on equal keys.
+        return sorted(entries, key=itemgetter(0))
 
 
 if __name__ == '__main__':